@@ -1,28 +1,132 @@
-import json
+import asyncio
+import functools
 import logging
 import os
+import re
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 
 import httpx
+import orjson
+from cachetools import TTLCache
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import Response
 
 from google import genai
 from google.genai import types
+from google.genai.chats import AsyncChat
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 log = logging.getLogger("receptionist")
 
-app = FastAPI()
-
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 N8N_CALL_START_URL = os.environ.get("N8N_CALL_START_URL")
 N8N_BOOK_APPOINTMENT_URL = os.environ.get("N8N_BOOK_APPOINTMENT_URL")
 N8N_POST_CALL_URL = os.environ.get("N8N_POST_CALL_URL")
+MAX_CONCURRENT_CALLS = int(os.environ.get("MAX_CALLS", "200"))
+CLIENT_CONFIG_TTL = int(os.environ.get("CLIENT_CONFIG_TTL", "300"))
+CALL_IDLE_TTL = int(os.environ.get("CALL_IDLE_TTL", "180"))
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_PING_INTERVAL = 60
+REQUIRED_ENV = ("N8N_CALL_START_URL", "N8N_BOOK_APPOINTMENT_URL", "N8N_POST_CALL_URL")
+
+# Created in lifespan once the environment has been checked
+gemini_client: genai.Client | None = None
+
+# One pooled client for all n8n webhooks so connections are kept alive between calls
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(10.0, connect=2.0, write=5.0, pool=1.0),
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128, keepalive_expiry=120),
+)
+
+
+@dataclass(slots=True)
+class Session:
+    caller_phone: str = ""
+    called_number: str = ""
+    company_name: str = ""
+    calendar_id: str = ""
+    timezone: str = "UTC"
+    system_prompt: str = "You are a helpful receptionist."
+    client_record_id: str = ""
+    greeting: str = ""
+    chat: AsyncChat | None = None
+    pending_reply: asyncio.Task | None = None
+    pending_spoken: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    appointment_booked: bool = False
+    caller_name: str = ""
+    caller_email: str = ""
+    appointment_time: str = ""
+    reason: str = ""
+
+
+class SessionStore(TTLCache):
+    # TTLCache expires and evicts entries inside len() and set() and discards them,
+    # so log here to catch every session that never reached a goodbye or Flow C
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for call_sid, _ in expired:
+            log.info("Session expired without a goodbye; Flow C not sent | sid=%s", call_sid)
+        return expired
+
+    def popitem(self):
+        call_sid, session = super().popitem()
+        log.warning("Session evicted at capacity | sid=%s", call_sid)
+        return call_sid, session
+
+
+# In-memory store per call; calls that never say goodbye expire after an hour
+call_store: SessionStore = SessionStore(maxsize=10_000, ttl=3600)
+
+# Calls that hit a webhook in the last CALL_IDLE_TTL seconds; MAX_CALLS counts these,
+# not call_store, which keeps a session for an hour after a call ends without a goodbye
+active_calls: TTLCache[str, None] = TTLCache(maxsize=10_000, ttl=max(CALL_IDLE_TTL, 1))
+
+# Flow A client config by called number; set CLIENT_CONFIG_TTL=0 to always ask n8n
+client_config_cache: TTLCache[str, dict] = TTLCache(maxsize=1024, ttl=max(CLIENT_CONFIG_TTL, 1))
+
+# Fire-and-forget tasks, held here so they aren't garbage collected mid-flight
+background_tasks: set[asyncio.Task] = set()
+
+# Finished calls waiting to be reported to n8n Flow C
+post_call_queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global gemini_client
+    # Refuse to start rather than fail every call on a missing webhook or key
+    missing = [name for name in REQUIRED_ENV if not os.environ.get(name)]
+    if not (GEMINI_API_KEY or os.environ.get("GOOGLE_API_KEY")):
+        missing.insert(0, "GEMINI_API_KEY")
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+    # Keep idle Gemini connections well past the ping interval; httpx drops them after 5s by default
+    gemini_client = genai.Client(
+        api_key=GEMINI_API_KEY,
+        http_options=types.HttpOptions(
+            async_client_args={"http2": True, "limits": httpx.Limits(keepalive_expiry=GEMINI_PING_INTERVAL * 2)},
+        ),
+    )
+    worker = asyncio.create_task(post_call_worker())
+    monitor = asyncio.create_task(call_store_monitor())
+    keepalive = asyncio.create_task(gemini_keepalive())
+    yield
+    keepalive.cancel()
+    monitor.cancel()
+    try:
+        # Give calls that already hung up a chance to reach Flow C
+        await asyncio.wait_for(post_call_queue.join(), timeout=10)
+    except asyncio.TimeoutError:
+        log.warning("Flow C queue not drained on shutdown | pending=%d", post_call_queue.qsize())
+    worker.cancel()
+    await http_client.aclose()
 
-gemini_client = genai.Client(api_key=GEMINI_API_KEY)
 
-# In-memory store per call
-call_store: dict = {}
+app = FastAPI(lifespan=lifespan)
 
 
 # ──────────────────────────────────────────────
@@ -30,12 +134,15 @@ call_store: dict = {}
 # ──────────────────────────────────────────────
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return HEALTH_RESPONSE
 
 
 # ──────────────────────────────────────────────
 # STEP 1 — Twilio calls this when phone rings
 # ──────────────────────────────────────────────
+DEFAULT_GREETING = "Thanks for calling {companyName}. How can I help you today?"
+
+
 @app.post("/incoming-call")
 async def incoming_call(request: Request):
     try:
@@ -43,292 +150,483 @@ async def incoming_call(request: Request):
         caller_phone = form.get("From", "")
         called_number = form.get("To", "")
         call_sid = form.get("CallSid", "")
-        log.info(f"Incoming call | from={caller_phone} to={called_number} sid={call_sid}")
+        log.info("Incoming call | from=%s to=%s sid=%s", caller_phone, called_number, call_sid)
+
+        if len(active_calls) >= MAX_CONCURRENT_CALLS:
+            log.warning("At capacity, rejecting call | active=%d sid=%s", len(active_calls), call_sid)
+            return BUSY_TWIML
 
         client_config = await lookup_client(caller_phone, called_number, call_sid)
 
         if not client_config:
-            log.warning(f"No client config for {called_number}")
-            return twiml_response("<Say>Sorry, this number is not configured. Goodbye.</Say><Hangup/>")
-
-        company_name = client_config.get("companyName", "our business")
-        system_prompt = client_config.get("systemPrompt", "You are a helpful receptionist.")
-
-        call_store[call_sid] = {
-            "callerPhone": caller_phone,
-            "calledNumber": called_number,
-            "companyName": company_name,
-            "calendarId": client_config.get("calendarId", ""),
-            "timezone": client_config.get("timezone", "UTC"),
-            "systemPrompt": system_prompt,
-            "clientRecordId": client_config.get("clientRecordId", ""),
-            "history": [],
-            "appointmentBooked": False,
-            "callerName": "",
-            "callerEmail": "",
-            "appointmentTime": "",
-            "reason": "",
-        }
-
-        greeting = await ask_gemini(
-            call_sid,
-            f"Greet the caller warmly as the receptionist for {company_name}. Be friendly and ask how you can help. Keep it to 1-2 sentences.",
-        )
-        log.info(f"Greeting: {greeting}")
-
-        host = request.headers.get("host", "")
-        gather_url = f"https://{host}/gather"
-
-        return twiml_response(
-            f'<Say voice="Polly.Joanna">{escape_xml(greeting)}</Say>'
-            f'<Gather input="speech" action="{gather_url}" method="POST" '
-            f'speechTimeout="2" speechModel="phone_call" enhanced="true" timeout="10">'
-            f"</Gather>"
-            f'<Say voice="Polly.Joanna">I didn\'t catch that. Please call back and try again.</Say>'
-            f"<Hangup/>"
+            log.warning("No client config for %s", called_number)
+            return NOT_CONFIGURED_TWIML
+
+        # Flow A may send nulls, so fall back on any empty value, not just a missing key
+        company_name = client_config.get("companyName") or "our business"
+        system_prompt = client_config.get("systemPrompt") or "You are a helpful receptionist."
+
+        # Fixed greeting, so the phone is answered without waiting on Gemini
+        greeting_template = client_config.get("greetingTemplate") or DEFAULT_GREETING
+        greeting = greeting_template.replace("{companyName}", company_name)
+        log.debug("Greeting: %s", greeting)
+
+        call_store[call_sid] = Session(
+            caller_phone=caller_phone,
+            called_number=called_number,
+            company_name=company_name,
+            calendar_id=client_config.get("calendarId", ""),
+            timezone=client_config.get("timezone", "UTC"),
+            system_prompt=system_prompt,
+            client_record_id=client_config.get("clientRecordId", ""),
+            greeting=greeting,
         )
+        active_calls[call_sid] = None
+
+        gather_tag = gather_twiml(request.headers.get("host", ""))
+
+        return twiml_response(say(greeting) + gather_tag + NO_INPUT_GOODBYE_SAY + "<Hangup/>")
 
     except Exception:
         log.exception("CRASH in /incoming-call")
-        return twiml_response("<Say>Sorry, something went wrong. Please try again.</Say><Hangup/>")
+        return ERROR_TWIML
 
 
 # ──────────────────────────────────────────────
 # STEP 2 — Twilio sends caller speech here after each turn
 # ──────────────────────────────────────────────
+GOODBYE_RE = re.compile(r"\b(goodbye|bye|hang up|end call|that's all|thank you goodbye)\b", re.IGNORECASE)
+
+
 @app.post("/gather")
 async def gather(request: Request):
     try:
         form = await request.form()
         call_sid = form.get("CallSid", "")
         speech_result = form.get("SpeechResult", "").strip()
-        log.info(f"Speech | sid={call_sid} | text='{speech_result}'")
+        log.info("Speech | sid=%s | text=%r", call_sid, speech_result)
 
-        host = request.headers.get("host", "")
-        gather_url = f"https://{host}/gather"
+        gather_tag = gather_twiml(request.headers.get("host", ""))
 
         if not speech_result:
-            return twiml_response(
-                '<Say voice="Polly.Joanna">Sorry, I didn\'t catch that. Could you say that again?</Say>'
-                f'<Gather input="speech" action="{gather_url}" method="POST" '
-                f'speechTimeout="2" speechModel="phone_call" enhanced="true" timeout="10">'
-                f"</Gather>"
-                "<Hangup/>"
-            )
+            return twiml_response(SAY_AGAIN_SAY + gather_tag + "<Hangup/>")
 
         session = call_store.get(call_sid)
         if not session:
-            return twiml_response("<Say>Sorry, your session expired. Please call back.</Say><Hangup/>")
-
-        # Check if caller wants to end the call
-        lower = speech_result.lower()
-        if any(w in lower for w in ["goodbye", "bye", "hang up", "that's all", "thank you goodbye"]):
-            farewell = await ask_gemini(call_sid, speech_result)
-            await trigger_post_call(call_sid)
-            return twiml_response(
-                f'<Say voice="Polly.Joanna">{escape_xml(farewell)}</Say><Hangup/>'
-            )
-
-        gemini_reply = await ask_gemini(call_sid, speech_result)
-        log.info(f"Gemini reply: {gemini_reply}")
-
-        # Check if Gemini wants to book an appointment
-        if "[[BOOK_APPOINTMENT:" in gemini_reply:
-            return await process_booking(call_sid, gemini_reply, gather_url)
-
-        return twiml_response(
-            f'<Say voice="Polly.Joanna">{escape_xml(gemini_reply)}</Say>'
-            f'<Gather input="speech" action="{gather_url}" method="POST" '
-            f'speechTimeout="2" speechModel="phone_call" enhanced="true" timeout="10">'
-            f"</Gather>"
-            f'<Say voice="Polly.Joanna">Are you still there?</Say>'
-            f'<Gather input="speech" action="{gather_url}" method="POST" '
-            f'speechTimeout="2" speechModel="phone_call" enhanced="true" timeout="10">'
-            f"</Gather>"
-            f"<Hangup/>"
-        )
+            return SESSION_EXPIRED_TWIML
+        active_calls[call_sid] = None
+
+        # One turn at a time per call, so retried webhooks can't interleave the chat
+        async with session.lock:
+            # A reply still streaming from the previous turn must land in the chat first
+            if session.pending_reply:
+                await asyncio.wait([session.pending_reply])
+
+            # Check if caller wants to end the call
+            if GOODBYE_RE.search(speech_result):
+                farewell = await ask_gemini(call_sid, speech_result)
+                enqueue_post_call(call_sid)
+                return twiml_response(say(farewell) + "<Hangup/>")
+
+            # Start speaking as soon as the first sentence is ready; /continue says the rest
+            gemini_reply, more = await ask_gemini_streaming(call_sid, speech_result)
+            log.debug("Gemini reply: %s | more=%s", gemini_reply, more)
+
+            if more:
+                return twiml_response(say(gemini_reply) + continue_twiml(request.headers.get("host", "")))
+
+            return await reply_twiml(call_sid, gemini_reply, gather_tag)
 
     except Exception:
         log.exception("CRASH in /gather")
-        return twiml_response("<Say>Sorry, something went wrong. Please try again.</Say><Hangup/>")
+        return ERROR_TWIML
 
 
 # ──────────────────────────────────────────────
-# GEMINI — Text chat with conversation history
+# STEP 3 — Twilio redirects here for the rest of a streamed reply
 # ──────────────────────────────────────────────
-async def ask_gemini(call_sid: str, user_message: str) -> str:
-    session = call_store.get(call_sid, {})
-    system_prompt = session.get("systemPrompt", "You are a helpful receptionist.")
-    history = session.get("history", [])
-    calendar_id = session.get("calendarId", "")
-    timezone = session.get("timezone", "UTC")
-
-    booking_instruction = (
-        "\n\nWhen the caller wants to book an appointment and you have their name, email, "
-        "preferred date, time, and reason — include this marker at the very end of your reply "
-        "(after your spoken words):\n"
-        '[[BOOK_APPOINTMENT:{"callerName":"NAME","callerEmail":"EMAIL",'
-        '"date":"YYYY-MM-DD","time":"HH:MM","reason":"REASON","durationMinutes":60}]]\n'
-        f"Calendar ID: {calendar_id}\nTimezone: {timezone}"
-    )
+@app.post("/continue")
+async def continue_reply(request: Request):
+    try:
+        form = await request.form()
+        call_sid = form.get("CallSid", "")
+
+        gather_tag = gather_twiml(request.headers.get("host", ""))
+
+        session = call_store.get(call_sid)
+        if not session:
+            return SESSION_EXPIRED_TWIML
+        active_calls[call_sid] = None
 
-    full_system = system_prompt + booking_instruction
+        async with session.lock:
+            pending, session.pending_reply = session.pending_reply, None
+            rest = (await pending)[session.pending_spoken:].strip() if pending else ""
+            log.debug("Gemini reply (rest): %s", rest)
 
-    # Build messages list for Gemini
-    messages = []
-    for h in history:
-        role = "user" if h["role"] == "user" else "model"
-        messages.append(types.Content(role=role, parts=[types.Part(text=h["parts"][0])]))
+            return await reply_twiml(call_sid, rest, gather_tag)
+
+    except Exception:
+        log.exception("CRASH in /continue")
+        return ERROR_TWIML
 
-    messages.append(types.Content(role="user", parts=[types.Part(text=user_message)]))
 
+async def reply_twiml(call_sid: str, gemini_reply: str, gather_tag: str) -> Response:
+    # Check if Gemini wants to book an appointment
     try:
-        response = gemini_client.models.generate_content(
-            model="gemini-2.0-flash",
-            config=types.GenerateContentConfig(system_instruction=full_system),
-            contents=messages,
+        spoken_part, booking_data = parse_booking_marker(gemini_reply)
+    except ValueError:
+        log.exception("Bad booking marker | sid=%s", call_sid)
+        return twiml_response(BOOKING_FAILED_SAY + gather_tag + "<Hangup/>")
+
+    if booking_data is not None:
+        return await process_booking(call_sid, spoken_part, booking_data, gather_tag)
+
+    spoken = say(spoken_part) if spoken_part else ""
+    return twiml_response(spoken + gather_tag + STILL_THERE_SAY + gather_tag + "<Hangup/>")
+
+
+# ──────────────────────────────────────────────
+# GEMINI — Text chat with conversation history
+# ──────────────────────────────────────────────
+TECHNICAL_ISSUE_REPLY = "I'm sorry, I had a technical issue. Could you repeat that?"
+
+# Said while Gemini is still thinking, if no sentence is ready after FILLER_AFTER_SECONDS
+FILLER_REPLY = "Let me check that."
+FILLER_AFTER_SECONDS = 1.0
+
+# End of a sentence: terminal punctuation followed by whitespace
+SENTENCE_END_RE = re.compile(r"[.!?]\s")
+
+
+def get_chat(session: Session) -> AsyncChat:
+    # One chat per call; the SDK keeps the conversation history for us
+    if session.chat is None:
+        # The greeting was said without Gemini; tell it so it doesn't greet the caller again
+        history = [
+            types.Content(role="user", parts=[types.Part(text=f"The caller was greeted with: {session.greeting}")]),
+            types.Content(role="model", parts=[types.Part(text=session.greeting)]),
+        ] if session.greeting else None
+        session.chat = gemini_client.aio.chats.create(
+            model=GEMINI_MODEL,
+            config=build_config(session.system_prompt, session.calendar_id, session.timezone),
+            history=history,
         )
-        reply = response.text.strip()
+    return session.chat
 
-        # Save to history
-        history.append({"role": "user", "parts": [user_message]})
-        history.append({"role": "model", "parts": [reply]})
-        session["history"] = history
 
+async def ask_gemini(call_sid: str, user_message: str) -> str:
+    session = call_store.get(call_sid) or Session()
+
+    try:
+        response = await get_chat(session).send_message(user_message)
+        return response.text.strip()
+
+    except Exception:
+        log.exception("ask_gemini error | sid=%s", call_sid)
+        return TECHNICAL_ISSUE_REPLY
+
+
+async def ask_gemini_streaming(call_sid: str, user_message: str) -> tuple[str, bool]:
+    session = call_store.get(call_sid) or Session()
+    first_sentence = asyncio.get_running_loop().create_future()
+    task = asyncio.create_task(stream_gemini(call_sid, session, user_message, first_sentence))
+
+    done, _ = await asyncio.wait([first_sentence], timeout=FILLER_AFTER_SECONDS)
+    if not done:
+        # Nothing to say yet; cover the wait with a filler and say the whole reply in /continue
+        session.pending_reply, session.pending_spoken = task, 0
+        return FILLER_REPLY, True
+
+    sentence = first_sentence.result()
+    if sentence:
+        # The rest keeps streaming while Twilio speaks the first sentence
+        session.pending_reply, session.pending_spoken = task, len(sentence)
+        return sentence.strip(), True
+
+    return (await task).strip(), False
+
+
+async def stream_gemini(call_sid: str, session: Session, user_message: str, first_sentence: asyncio.Future) -> str:
+    reply = ""
+    cut = 0
+    try:
+        async for chunk in await get_chat(session).send_message_stream(user_message):
+            reply += chunk.text or ""
+            # Never split a reply that carries a booking marker
+            if not cut and "[[" not in reply:
+                match = SENTENCE_END_RE.search(reply)
+                if match:
+                    cut = match.end()
+                    first_sentence.set_result(reply[:cut])
+
+        if len(session.chat.get_history(curated=True)) > MAX_HISTORY:
+            spawn(compact_history(call_sid, session))
         return reply
 
     except Exception:
-        log.exception(f"ask_gemini error | sid={call_sid}")
-        return "I'm sorry, I had a technical issue. Could you repeat that?"
+        log.exception("stream_gemini error | sid=%s", call_sid)
+        return reply if cut else TECHNICAL_ISSUE_REPLY
+
+    finally:
+        if not first_sentence.done():
+            first_sentence.set_result("")
+
+
+# Past this many history entries (user + model), older turns are folded into a summary
+MAX_HISTORY = 20
+KEEP_RECENT = 10
+SUMMARY_TIMEOUT = 10.0
+SUMMARY_PROMPT = (
+    "Summarize this phone call so far in 3 short lines. Keep the caller's name, email, "
+    "requested date and time, and reason for calling if they were given."
+)
+
+
+async def compact_history(call_sid: str, session: Session):
+    # Summarise outside the lock so caller turns never wait on the summary round-trip
+    async with session.lock:
+        chat = session.chat
+        history = chat.get_history(curated=True)
+    if len(history) <= MAX_HISTORY:
+        return
+    older, recent = history[:-KEEP_RECENT], history[-KEEP_RECENT:]
+
+    try:
+        response = await asyncio.wait_for(
+            gemini_client.aio.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=older + [types.Content(role="user", parts=[types.Part(text=SUMMARY_PROMPT)])],
+            ),
+            timeout=SUMMARY_TIMEOUT,
+        )
+        summary = response.text.strip()
+    except Exception:
+        log.exception("compact_history error | sid=%s", call_sid)
+        return
+
+    async with session.lock:
+        # A turn landed or is still streaming; leave it for the next compaction
+        in_flight = session.pending_reply is not None and not session.pending_reply.done()
+        if session.chat is not chat or in_flight or len(chat.get_history(curated=True)) != len(history):
+            return
+        session.chat = gemini_client.aio.chats.create(
+            model=GEMINI_MODEL,
+            config=build_config(session.system_prompt, session.calendar_id, session.timezone),
+            history=[
+                types.Content(role="user", parts=[types.Part(text=f"Summary of the call so far: {summary}")]),
+                types.Content(role="model", parts=[types.Part(text="Understood.")]),
+                *recent,
+            ],
+        )
+    log.info("History compacted | sid=%s | dropped=%d", call_sid, len(older))
+
+
+BOOKING_INSTRUCTION_TEMPLATE = (
+    "\n\nWhen the caller wants to book an appointment and you have their name, email, "
+    "preferred date, time, and reason — start your reply with this marker "
+    "(before your spoken words):\n"
+    '[[BOOK_APPOINTMENT:{{"callerName":"NAME","callerEmail":"EMAIL",'
+    '"date":"YYYY-MM-DD","time":"HH:MM","reason":"REASON","durationMinutes":60}}]]\n'
+    "Calendar ID: {calendar_id}\nTimezone: {timezone}"
+)
+
+
+# Same tenant config on every turn, so build it once and reuse it
+@functools.lru_cache(maxsize=256)
+def build_config(system_prompt: str, calendar_id: str, timezone: str) -> types.GenerateContentConfig:
+    booking_instruction = BOOKING_INSTRUCTION_TEMPLATE.format(calendar_id=calendar_id, timezone=timezone)
+    return types.GenerateContentConfig(system_instruction=system_prompt + booking_instruction)
 
 
 # ──────────────────────────────────────────────
 # BOOKING — Parse Gemini marker and call Flow B
 # ──────────────────────────────────────────────
-async def process_booking(call_sid: str, gemini_reply: str, gather_url: str) -> HTMLResponse:
-    session = call_store.get(call_sid, {})
+BOOKING_MARKER = "[[BOOK_APPOINTMENT:"
 
-    try:
-        parts = gemini_reply.split("[[BOOK_APPOINTMENT:")
-        spoken_part = parts[0].strip()
-        booking_json_str = parts[1].rstrip("]]").strip()
-        booking_data = json.loads(booking_json_str)
 
-        booking_data["calendarId"] = session.get("calendarId")
-        booking_data["timezone"] = session.get("timezone")
-        booking_data["companyName"] = session.get("companyName")
-        booking_data["clientRecordId"] = session.get("clientRecordId")
-        booking_data["callerPhone"] = session.get("callerPhone")
+def parse_booking_marker(reply: str) -> tuple[str, dict | None]:
+    before, sep, tail = reply.partition(BOOKING_MARKER)
+    if not sep:
+        return reply.strip(), None
+    # The payload is a JSON object, so the marker closes with "}]]"
+    end = tail.find("}]]") + 1
+    if not end:
+        raise ValueError("Unterminated booking marker")
+    return (before + tail[end + 2:]).strip(), orjson.loads(tail[:end])
+
 
-        async with httpx.AsyncClient(timeout=15) as http:
-            resp = await http.post(N8N_BOOK_APPOINTMENT_URL, json=booking_data)
-        result = resp.json()
+async def process_booking(call_sid: str, spoken_part: str, booking_data: dict, gather_tag: str) -> Response:
+    session = call_store.get(call_sid) or Session()
+
+    try:
+        booking_data["calendarId"] = session.calendar_id
+        booking_data["timezone"] = session.timezone
+        booking_data["companyName"] = session.company_name
+        booking_data["clientRecordId"] = session.client_record_id
+        booking_data["callerPhone"] = session.caller_phone
+
+        resp = await post_json(
+            N8N_BOOK_APPOINTMENT_URL,
+            booking_data,
+            timeout=httpx.Timeout(15.0, connect=2.0, write=5.0, pool=1.0),
+        )
+        result = orjson.loads(resp.content)
 
         if result.get("success"):
-            session["appointmentBooked"] = True
-            session["appointmentTime"] = booking_data.get("date", "") + " " + booking_data.get("time", "")
-            session["callerName"] = booking_data.get("callerName", "")
-            session["callerEmail"] = booking_data.get("callerEmail", "")
-            session["reason"] = booking_data.get("reason", "")
-            log.info(f"Booking confirmed | sid={call_sid}")
+            session.appointment_booked = True
+            session.appointment_time = booking_data.get("date", "") + " " + booking_data.get("time", "")
+            session.caller_name = booking_data.get("callerName", "")
+            session.caller_email = booking_data.get("callerEmail", "")
+            session.reason = booking_data.get("reason", "")
+            log.info("Booking confirmed | sid=%s", call_sid)
 
             confirmation = spoken_part or "Your appointment is confirmed! You'll receive a confirmation email shortly."
-            return twiml_response(
-                f'<Say voice="Polly.Joanna">{escape_xml(confirmation)}</Say>'
-                f'<Gather input="speech" action="{gather_url}" method="POST" '
-                f'speechTimeout="2" speechModel="phone_call" enhanced="true" timeout="10">'
-                f"</Gather>"
-                f"<Hangup/>"
-            )
+            return twiml_response(say(confirmation) + gather_tag + "<Hangup/>")
         else:
-            sorry = "I'm sorry, that time slot isn't available. Would you like to try a different time?"
-            return twiml_response(
-                f'<Say voice="Polly.Joanna">{escape_xml(sorry)}</Say>'
-                f'<Gather input="speech" action="{gather_url}" method="POST" '
-                f'speechTimeout="2" speechModel="phone_call" enhanced="true" timeout="10">'
-                f"</Gather>"
-                f"<Hangup/>"
-            )
+            return twiml_response(SLOT_UNAVAILABLE_SAY + gather_tag + "<Hangup/>")
 
     except Exception:
-        log.exception(f"process_booking error | sid={call_sid}")
-        sorry = "I had trouble booking that. Could you try again?"
-        return twiml_response(
-            f'<Say voice="Polly.Joanna">{escape_xml(sorry)}</Say>'
-            f'<Gather input="speech" action="{gather_url}" method="POST" '
-            f'speechTimeout="2" speechModel="phone_call" enhanced="true" timeout="10">'
-            f"</Gather>"
-            f"<Hangup/>"
-        )
+        log.exception("process_booking error | sid=%s", call_sid)
+        return twiml_response(BOOKING_FAILED_SAY + gather_tag + "<Hangup/>")
 
 
 # ──────────────────────────────────────────────
 # LOOKUP — Ask n8n Flow A who is being called
 # ──────────────────────────────────────────────
 async def lookup_client(caller_phone: str, called_number: str, call_sid: str):
+    cached = client_config_cache.get(called_number) if CLIENT_CONFIG_TTL else None
+    if cached is not None:
+        # Answer from cache; Flow A still hears about this call and refreshes the entry
+        spawn(fetch_client(caller_phone, called_number, call_sid))
+        return cached
+
+    return await fetch_client(caller_phone, called_number, call_sid)
+
+
+async def fetch_client(caller_phone: str, called_number: str, call_sid: str):
     try:
-        async with httpx.AsyncClient(timeout=10) as http:
-            resp = await http.post(
-                N8N_CALL_START_URL,
-                json={
-                    "callerPhone": caller_phone,
-                    "calledNumber": called_number,
-                    "callSid": call_sid,
-                },
-            )
-        log.info(f"Flow A | status={resp.status_code} | body={resp.text[:300]}")
+        resp = await post_json(
+            N8N_CALL_START_URL,
+            {
+                "callerPhone": caller_phone,
+                "calledNumber": called_number,
+                "callSid": call_sid,
+            },
+        )
+        log.info("Flow A | status=%d", resp.status_code)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Flow A body | %s", resp.text[:300])
 
         if resp.status_code != 200:
             return None
 
-        body = resp.text.strip()
+        body = resp.content.strip()
         if not body:
             return None
 
-        data = json.loads(body)
-        return data if data.get("success") else None
+        data = orjson.loads(body)
+        if not data.get("success"):
+            client_config_cache.pop(called_number, None)
+            return None
+
+        if CLIENT_CONFIG_TTL:
+            client_config_cache[called_number] = data
+        return data
 
     except Exception:
-        log.exception("lookup_client failed")
+        log.exception("fetch_client failed")
         return None
 
 
 # ──────────────────────────────────────────────
 # POST-CALL — Trigger n8n Flow C after hang up
 # ──────────────────────────────────────────────
-async def trigger_post_call(call_sid: str):
-    data = call_store.pop(call_sid, {})
-    if not data:
+def enqueue_post_call(call_sid: str):
+    active_calls.pop(call_sid, None)
+    session = call_store.pop(call_sid, None)
+    if session is None:
         return
+    try:
+        post_call_queue.put_nowait((call_sid, session))
+    except asyncio.QueueFull:
+        log.warning("Flow C queue full, dropping | sid=%s", call_sid)
+
+
+async def post_call_worker():
+    while True:
+        call_sid, session = await post_call_queue.get()
+        try:
+            await trigger_post_call(call_sid, session)
+        finally:
+            post_call_queue.task_done()
+
+
+async def trigger_post_call(call_sid: str, session: Session):
     try:
         payload = {
-            "callerName": data.get("callerName", "Valued Customer"),
-            "callerEmail": data.get("callerEmail", ""),
-            "callerPhone": data.get("callerPhone", ""),
-            "companyName": data.get("companyName", ""),
-            "appointmentTime": data.get("appointmentTime", ""),
-            "reason": data.get("reason", ""),
+            "callerName": session.caller_name,
+            "callerEmail": session.caller_email,
+            "callerPhone": session.caller_phone,
+            "companyName": session.company_name,
+            "appointmentTime": session.appointment_time,
+            "reason": session.reason,
             "callSummary": "Call completed via voice receptionist.",
-            "clientTwilioPhone": data.get("calledNumber", ""),
-            "clientRecordId": data.get("clientRecordId", ""),
-            "appointmentBooked": data.get("appointmentBooked", False),
+            "clientTwilioPhone": session.called_number,
+            "clientRecordId": session.client_record_id,
+            "appointmentBooked": session.appointment_booked,
         }
-        log.info(f"Flow C trigger | sid={call_sid} | booked={payload['appointmentBooked']}")
-        async with httpx.AsyncClient(timeout=10) as http:
-            resp = await http.post(N8N_POST_CALL_URL, json=payload)
-        log.info(f"Flow C response | {resp.status_code}")
+        log.info("Flow C trigger | sid=%s | booked=%s", call_sid, payload["appointmentBooked"])
+        resp = await post_json(N8N_POST_CALL_URL, payload)
+        log.info("Flow C response | %d", resp.status_code)
     except Exception:
-        log.exception(f"trigger_post_call error | sid={call_sid}")
+        log.exception("trigger_post_call error | sid=%s", call_sid)
+
+
+# ──────────────────────────────────────────────
+# HOUSEKEEPING — Gemini keep-alive and session expiry
+# ──────────────────────────────────────────────
+async def gemini_keepalive():
+    # The first Gemini call only comes after a caller's first turn, so keep the
+    # connection open with a cheap request instead of warming it once at startup
+    while True:
+        try:
+            await asyncio.wait_for(gemini_client.aio.models.get(model=GEMINI_MODEL), timeout=10)
+        except Exception:
+            log.warning("Gemini keep-alive failed", exc_info=True)
+        await asyncio.sleep(GEMINI_PING_INTERVAL)
+
+
+async def call_store_monitor():
+    while True:
+        await asyncio.sleep(60)
+        # Flush sessions that timed out while no call came in; SessionStore logs them
+        call_store.expire()
+        log.info("Active calls | count=%d sessions=%d", len(active_calls), len(call_store))
 
 
 # ──────────────────────────────────────────────
 # HELPERS
 # ──────────────────────────────────────────────
-def twiml_response(body: str) -> HTMLResponse:
-    return HTMLResponse(
-        content=f'<?xml version="1.0" encoding="UTF-8"?><Response>{body}</Response>',
-        media_type="text/xml",
-    )
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+async def post_json(url: str, payload: dict, **kwargs) -> httpx.Response:
+    return await http_client.post(url, content=orjson.dumps(payload), headers=JSON_HEADERS, **kwargs)
+
+
+TWIML_HEAD = b'<?xml version="1.0" encoding="UTF-8"?><Response>'
+TWIML_TAIL = b"</Response>"
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def twiml_response(body: str) -> Response:
+    return Response(content=TWIML_HEAD + body.encode() + TWIML_TAIL, media_type="text/xml")
 
 
 def escape_xml(text: str) -> str:
@@ -341,10 +639,50 @@ def escape_xml(text: str) -> str:
     )
 
 
+SAY_TEMPLATE = '<Say voice="Polly.Joanna">{}</Say>'
+GATHER_TEMPLATE = (
+    '<Gather input="speech" action="https://{host}/gather" method="POST" '
+    'speechTimeout="2" speechModel="phone_call" enhanced="true" timeout="10">'
+    "</Gather>"
+)
+CONTINUE_TEMPLATE = '<Redirect method="POST">https://{host}/continue</Redirect>'
+
+
+def say(text: str) -> str:
+    return SAY_TEMPLATE.format(escape_xml(text))
+
+
+# Twilio always calls back on the same host, so these are effectively constants
+@functools.lru_cache(maxsize=8)
+def gather_twiml(host: str) -> str:
+    return GATHER_TEMPLATE.format(host=escape_xml(host))
+
+
+@functools.lru_cache(maxsize=8)
+def continue_twiml(host: str) -> str:
+    return CONTINUE_TEMPLATE.format(host=escape_xml(host))
+
+
+# Fixed prompts, escaped once at import
+NO_INPUT_GOODBYE_SAY = say("I didn't catch that. Please call back and try again.")
+SAY_AGAIN_SAY = say("Sorry, I didn't catch that. Could you say that again?")
+STILL_THERE_SAY = say("Are you still there?")
+SLOT_UNAVAILABLE_SAY = say("I'm sorry, that time slot isn't available. Would you like to try a different time?")
+BOOKING_FAILED_SAY = say("I had trouble booking that. Could you try again?")
+
+
+# Fixed responses, built once at import and reused for every request
+HEALTH_RESPONSE = Response(content=b'{"status":"ok"}', media_type="application/json")
+BUSY_TWIML = twiml_response('<Reject reason="busy"/>')
+NOT_CONFIGURED_TWIML = twiml_response("<Say>Sorry, this number is not configured. Goodbye.</Say><Hangup/>")
+SESSION_EXPIRED_TWIML = twiml_response("<Say>Sorry, your session expired. Please call back.</Say><Hangup/>")
+ERROR_TWIML = twiml_response("<Say>Sorry, something went wrong. Please try again.</Say><Hangup/>")
+
+
 # ──────────────────────────────────────────────
 # ENTRY POINT
 # ──────────────────────────────────────────────
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools")
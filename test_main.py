@@ -0,0 +1,340 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import main
+
+CALL_SID = "CA123"
+
+
+class FakeChat:
+    # Stands in for AsyncChat: each reply is a list of (delay, text) chunks
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.history = []
+        self.history_at_send = []
+        self.streaming = False
+
+    async def send_message_stream(self, message):
+        self.history_at_send.append(len(self.history))
+        chunks = self.replies.pop(0)
+
+        async def stream():
+            self.streaming = True
+            for delay, text in chunks:
+                await asyncio.sleep(delay)
+                yield SimpleNamespace(text=text)
+            self.history += [message, "".join(text for _, text in chunks)]
+            self.streaming = False
+
+        return stream()
+
+    def get_history(self, curated=False):
+        return list(self.history)
+
+
+class FakeGemini:
+    # Stands in for genai.Client: chats.create hands out the given FakeChats in order,
+    # generate_content answers with a summary once summary_gate is set
+    def __init__(self, *chats):
+        self.chats = list(chats)
+        self.summary_started = asyncio.Event()
+        self.summary_gate = asyncio.Event()
+        self.summary_contents = None
+        self.aio = SimpleNamespace(
+            chats=SimpleNamespace(create=self.create_chat),
+            models=SimpleNamespace(generate_content=self.generate_content),
+        )
+
+    def create_chat(self, model, config, history=None):
+        chat = self.chats.pop(0) if self.chats else FakeChat()
+        chat.history = list(history or [])
+        return chat
+
+    async def generate_content(self, model, contents):
+        self.summary_contents = contents
+        self.summary_started.set()
+        await self.summary_gate.wait()
+        return SimpleNamespace(text="Ann wants a cleaning on Tuesday.")
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    main.call_store.clear()
+    main.active_calls.clear()
+    yield
+    main.call_store.clear()
+    main.active_calls.clear()
+
+
+def start_call(chat: FakeChat) -> main.Session:
+    session = main.Session(company_name="Acme Dental", chat=chat)
+    main.call_store[CALL_SID] = session
+    return session
+
+
+async def post(client: httpx.AsyncClient, path: str, **form) -> str:
+    resp = await client.post(path, data={"CallSid": CALL_SID, **form})
+    assert resp.status_code == 200
+    return resp.text
+
+
+def twilio_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="https://bridge.example.com")
+
+
+def test_first_sentence_then_rest_on_continue():
+    chat = FakeChat([(0, "Sure, I can help with that. "), (0.05, "What day works "), (0, "for you?")])
+    session = start_call(chat)
+
+    async def scenario():
+        async with twilio_client() as client:
+            first = await post(client, "/gather", SpeechResult="I need a cleaning")
+            assert "<Say voice=\"Polly.Joanna\">Sure, I can help with that.</Say>" in first
+            assert "https://bridge.example.com/continue</Redirect>" in first
+            assert "<Gather" not in first
+            assert session.pending_spoken == len("Sure, I can help with that. ")
+
+            rest = await post(client, "/continue")
+            assert "<Say voice=\"Polly.Joanna\">What day works for you?</Say>" in rest
+            assert "https://bridge.example.com/gather" in rest
+            assert session.pending_reply is None
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def booked(monkeypatch) -> list[dict]:
+    # Flow B stand-in: records each booking and confirms it
+    payloads = []
+
+    async def fake_post_json(url, payload, **kwargs):
+        payloads.append(payload)
+        return SimpleNamespace(content=b'{"success": true}')
+
+    monkeypatch.setattr(main, "post_json", fake_post_json)
+    return payloads
+
+
+def test_booking_marker_is_never_split(booked):
+    chat = FakeChat([
+        (0, '[[BOOK_APPOINTMENT:{"callerName":"Ann","callerEmail":"ann@example.com",'),
+        (0.02, '"date":"2026-10-20","time":"10:00","reason":"Cleaning. Annual checkup",'),
+        (0.02, '"durationMinutes":60}]] You are booked for Tuesday. '),
+        (0.02, "See you then!"),
+    ])
+    session = start_call(chat)
+
+    async def scenario():
+        async with twilio_client() as client:
+            reply = await post(client, "/gather", SpeechResult="Book me in, Ann, ann@example.com")
+            assert "/continue" not in reply
+            assert "BOOK_APPOINTMENT" not in reply
+            assert "<Say voice=\"Polly.Joanna\">You are booked for Tuesday. See you then!</Say>" in reply
+
+    asyncio.run(scenario())
+    assert len(booked) == 1
+    assert booked[0]["reason"] == "Cleaning. Annual checkup"
+    assert session.appointment_booked
+
+
+def test_filler_when_no_sentence_is_ready(monkeypatch):
+    monkeypatch.setattr(main, "FILLER_AFTER_SECONDS", 0.05)
+    chat = FakeChat([(0.2, "Tuesday at ten is open.")])
+    session = start_call(chat)
+
+    async def scenario():
+        async with twilio_client() as client:
+            first = await post(client, "/gather", SpeechResult="Anything on Tuesday?")
+            assert f"<Say voice=\"Polly.Joanna\">{main.FILLER_REPLY}</Say>" in first
+            assert "/continue</Redirect>" in first
+            assert session.pending_spoken == 0
+
+            rest = await post(client, "/continue")
+            assert "<Say voice=\"Polly.Joanna\">Tuesday at ten is open.</Say>" in rest
+
+    asyncio.run(scenario())
+
+
+def test_gather_retry_waits_for_pending_reply():
+    chat = FakeChat(
+        [(0, "Let me look. "), (0.2, "We have Monday at nine.")],
+        [(0, "Monday at nine it is.")],
+    )
+    start_call(chat)
+
+    async def scenario():
+        async with twilio_client() as client:
+            first = await post(client, "/gather", SpeechResult="What is free?")
+            assert "Let me look.</Say>" in first
+            assert chat.streaming
+
+            # Twilio retries /gather before /continue; the pending reply must land in the chat first
+            retry = await post(client, "/gather", SpeechResult="Monday please")
+            assert "<Say voice=\"Polly.Joanna\">Monday at nine it is.</Say>" in retry
+
+    asyncio.run(scenario())
+    assert chat.history_at_send == [0, 2]
+    assert chat.history[1] == "Let me look. We have Monday at nine."
+
+
+def test_first_turn_chat_already_holds_the_greeting(monkeypatch):
+    async def fake_lookup_client(caller_phone, called_number, call_sid):
+        return {"companyName": "Acme Dental"}
+
+    chat = FakeChat([(0, "Happy to help.")])
+    monkeypatch.setattr(main, "lookup_client", fake_lookup_client)
+    monkeypatch.setattr(main, "gemini_client", FakeGemini(chat))
+
+    async def scenario():
+        async with twilio_client() as client:
+            answer = await post(client, "/incoming-call", From="+15550100", To="+15550199")
+            assert "Thanks for calling Acme Dental. How can I help you today?</Say>" in answer
+            await post(client, "/gather", SpeechResult="I need a cleaning")
+
+    asyncio.run(scenario())
+    assert chat.history_at_send == [2]
+    assert chat.history[1].role == "model"
+    assert chat.history[1].parts[0].text == "Thanks for calling Acme Dental. How can I help you today?"
+
+
+def test_null_company_name_and_template_fall_back(monkeypatch):
+    async def fake_lookup_client(caller_phone, called_number, call_sid):
+        return {"companyName": None, "greetingTemplate": None, "systemPrompt": None}
+
+    monkeypatch.setattr(main, "lookup_client", fake_lookup_client)
+
+    async def scenario():
+        async with twilio_client() as client:
+            answer = await post(client, "/incoming-call", From="+15550100", To="+15550199")
+            assert "Thanks for calling our business. How can I help you today?</Say>" in answer
+
+    asyncio.run(scenario())
+    assert main.call_store[CALL_SID].system_prompt == "You are a helpful receptionist."
+
+
+def long_call(monkeypatch) -> tuple[main.Session, FakeChat, FakeGemini]:
+    chat = FakeChat()
+    chat.history = [f"turn {i}" for i in range(main.MAX_HISTORY + 2)]
+    gemini = FakeGemini()
+    monkeypatch.setattr(main, "gemini_client", gemini)
+    return start_call(chat), chat, gemini
+
+
+def test_compact_history_summarises_outside_the_lock(monkeypatch):
+    session, chat, gemini = long_call(monkeypatch)
+
+    async def scenario():
+        task = asyncio.create_task(main.compact_history(CALL_SID, session))
+        await gemini.summary_started.wait()
+        # A caller turn can take the lock while the summary is still running
+        await asyncio.wait_for(session.lock.acquire(), timeout=0.1)
+        session.lock.release()
+        gemini.summary_gate.set()
+        await task
+
+    asyncio.run(scenario())
+    assert session.chat is not chat
+
+
+def test_compact_history_seeds_summary_and_recent_turns(monkeypatch):
+    session, chat, gemini = long_call(monkeypatch)
+    gemini.summary_gate.set()
+
+    asyncio.run(main.compact_history(CALL_SID, session))
+    older = chat.history[:-main.KEEP_RECENT]
+    assert gemini.summary_contents[:-1] == older
+    summary, understood, *recent = session.chat.history
+    assert summary.role == "user"
+    assert summary.parts[0].text == "Summary of the call so far: Ann wants a cleaning on Tuesday."
+    assert understood.role == "model"
+    assert understood.parts[0].text == "Understood."
+    assert recent == chat.history[-main.KEEP_RECENT:]
+
+
+def test_compact_history_drops_swap_when_history_grew(monkeypatch):
+    session, chat, gemini = long_call(monkeypatch)
+
+    async def scenario():
+        task = asyncio.create_task(main.compact_history(CALL_SID, session))
+        await gemini.summary_started.wait()
+        chat.history += ["caller again", "model again"]
+        gemini.summary_gate.set()
+        await task
+
+    asyncio.run(scenario())
+    assert session.chat is chat
+
+
+def test_compact_history_drops_swap_while_reply_streams(monkeypatch):
+    session, chat, gemini = long_call(monkeypatch)
+
+    async def scenario():
+        task = asyncio.create_task(main.compact_history(CALL_SID, session))
+        await gemini.summary_started.wait()
+        streaming = asyncio.Event()
+        session.pending_reply = asyncio.create_task(streaming.wait())
+        gemini.summary_gate.set()
+        await task
+        streaming.set()
+        await session.pending_reply
+
+    asyncio.run(scenario())
+    assert session.chat is chat
+
+
+def test_parse_booking_marker_without_marker():
+    assert main.parse_booking_marker("  What day works for you?  ") == ("What day works for you?", None)
+
+
+@pytest.mark.parametrize("reply", [
+    '[[BOOK_APPOINTMENT:{"callerName":"Ann","time":"10:00"}]] You are booked.',
+    'You are booked. [[BOOK_APPOINTMENT:{"callerName":"Ann","time":"10:00"}]]',
+])
+def test_parse_booking_marker_before_or_after_speech(reply):
+    assert main.parse_booking_marker(reply) == ("You are booked.", {"callerName": "Ann", "time": "10:00"})
+
+
+def test_parse_booking_marker_with_brackets_in_a_value():
+    reply = '[[BOOK_APPOINTMENT:{"reason":"bring x-rays]] please"}]] Done.'
+    assert main.parse_booking_marker(reply) == ("Done.", {"reason": "bring x-rays]] please"})
+
+
+def test_parse_booking_marker_unterminated():
+    with pytest.raises(ValueError):
+        main.parse_booking_marker('[[BOOK_APPOINTMENT:{"callerName":"Ann" You are booked.')
+
+
+def test_reply_twiml_speaks_a_plain_reply(booked):
+    start_call(FakeChat())
+    resp = asyncio.run(main.reply_twiml(CALL_SID, " What day works for you? ", "<Gather/>"))
+    assert b"<Say voice=\"Polly.Joanna\">What day works for you?</Say><Gather/>" in resp.body
+    assert booked == []
+
+
+def test_reply_twiml_books_from_a_marker_after_speech(booked):
+    session = start_call(FakeChat())
+    reply = 'You are all set. [[BOOK_APPOINTMENT:{"callerName":"Ann","date":"2026-10-20","time":"10:00"}]]'
+    resp = asyncio.run(main.reply_twiml(CALL_SID, reply, "<Gather/>"))
+    assert b"<Say voice=\"Polly.Joanna\">You are all set.</Say>" in resp.body
+    assert booked == [{
+        "callerName": "Ann",
+        "date": "2026-10-20",
+        "time": "10:00",
+        "calendarId": "",
+        "timezone": "UTC",
+        "companyName": "Acme Dental",
+        "clientRecordId": "",
+        "callerPhone": "",
+    }]
+    assert session.appointment_time == "2026-10-20 10:00"
+
+
+def test_reply_twiml_unterminated_marker_skips_flow_b(booked):
+    start_call(FakeChat())
+    resp = asyncio.run(main.reply_twiml(CALL_SID, '[[BOOK_APPOINTMENT:{"callerName":"Ann"', "<Gather/>"))
+    assert main.BOOKING_FAILED_SAY.encode() in resp.body
+    assert booked == []
+